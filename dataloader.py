@@ -4,11 +4,24 @@ import os.path as osp
 import imageio
 from tqdm import tqdm
 
+from pipeline import prefetch
 
-def load_middlebury_data(datadir):
+
+def load_rgb(view):
+    """The rgb image of a view, decoded from view["rgb_fn"] when it was not loaded yet"""
+    if "rgb" in view:
+        return view["rgb"]
+    return imageio.imread(view["rgb_fn"])
+
+
+def load_middlebury_data(datadir, load_images=True, num_workers=4):
     """
     "imgname.png k11 k12 k13 k21 k22 k23 k31 k32 k33 r11 r12 r13 r21 r22 r23 r31 r32 r33 t1 t2 t3"
         The projection matrix for that image is given by K*[R t]
+
+    With load_images, every image is decoded on num_workers threads and kept in view["rgb"].
+    Otherwise only view["rgb_fn"] is set, and two_view_pairs / plane_sweep decode the images with
+    load_rgb when they need them, overlapping the decoding with matching
     """
 
     # from the dataset readme
@@ -26,24 +39,30 @@ def load_middlebury_data(datadir):
     with open(viz_fn[0]) as f:
         ang_data = f.readlines()
     n_views = int(cam_data.pop(0))
+    image_fns = [osp.join(datadir, cam.split(" ")[0]) for cam in cam_data]
+    if load_images:
+        # every image is kept, so the lookahead only needs to keep the workers busy
+        images = prefetch(imageio.imread, image_fns, num_workers, num_workers)
+    else:
+        images = [None] * len(image_fns)
     DATA = []
-    for cam, ang in tqdm(zip(cam_data, ang_data)):
+    for cam, ang, image_fn, image in tqdm(zip(cam_data, ang_data, image_fns, images)):
         l = cam[:-1].split(" ")
-        image_fn = l.pop(0)
+        l.pop(0)
         l = np.array(l)
         _K, _R, _t = l[:9].reshape(3, 3), l[9:18].reshape(3, 3), l[18:]
         lat, lon = ang.split(" ")[:-1]
         lat, lon = float(lat), float(lon)
-        image = imageio.imread(osp.join(datadir, image_fn))
-        DATA.append(
-            {
-                "K": _K.astype(np.float),
-                "R": _R.astype(np.float),
-                "T": _t.astype(np.float),
-                "lat": lat,
-                "lon": lon,
-                "rgb": image,
-            }
-        )
+        view = {
+            "K": _K.astype(np.float),
+            "R": _R.astype(np.float),
+            "T": _t.astype(np.float),
+            "lat": lat,
+            "lon": lon,
+            "rgb_fn": image_fn,
+        }
+        if load_images:
+            view["rgb"] = image
+        DATA.append(view)
     assert len(DATA) == n_views
     return DATA
@@ -0,0 +1,49 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from profiler import NULL_PROFILER
+
+
+def prefetch(fn, items, num_workers=2, max_pending=2, profiler=None, wait_stage="prefetch_wait"):
+    """
+    Yield fn(item) for each item in order, computing the next results on a thread pool
+
+    While the caller works on one result, at most max_pending later items are being computed,
+    which keeps memory bounded; max_pending=0 computes each item on the pool only once the caller
+    asks for it. Meant for stages that release the GIL (image decoding, cv2.warpPerspective);
+    with num_workers=0 everything runs inline on the calling thread.
+
+    Input:
+        fn -- function applied to each item
+        items -- iterable of inputs
+        num_workers -- number of threads
+        max_pending -- number of results computed ahead of the caller
+        profiler -- optional Profiler, records the time the caller waits for each result under
+            wait_stage, i.e. the part of fn that is not hidden behind the caller's work
+        wait_stage -- name of the waiting stage
+    Output:
+        generator of fn(item), in the order of items
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    if num_workers <= 0:
+        for item in items:
+            with profiler.stage(wait_stage):
+                result = fn(item)
+            yield result
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque(pool.submit(fn, item) for item in islice(items, max_pending))
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            with profiler.stage(wait_stage):
+                result = pending.popleft().result()
+            yield result
+        while pending:
+            with profiler.stage(wait_stage):
+                result = pending.popleft().result()
+            yield result
@@ -1,5 +1,11 @@
 import numpy as np
 import cv2
+from tqdm import tqdm
+
+from dataloader import load_rgb
+from pipeline import prefetch
+from profiler import NULL_PROFILER
+from two_view_stereo import accum_dtype, compute_hsv_mask, image2patch_at, to_precision
 
 
 EPS = 1e-8
@@ -74,7 +80,15 @@ def project_points(K, Rt, points):
 
 
 def warp_neighbor_to_ref(
-    backproject_fn, project_fn, depth, neighbor_rgb, K_ref, Rt_ref, K_neighbor, Rt_neighbor
+    backproject_fn,
+    project_fn,
+    depth,
+    neighbor_rgb,
+    K_ref,
+    Rt_ref,
+    K_neighbor,
+    Rt_neighbor,
+    profiler=None,
 ):
     """
     Warp the neighbor view into the reference view
@@ -100,17 +114,21 @@ def warp_neighbor_to_ref(
         Rt_ref -- 3 x 4 camera extrinsics calibration matrix of reference view
         K_neighbor -- 3 x 3 camera intrinsics calibration matrix of neighbor view
         Rt_neighbor -- 3 x 4 camera extrinsics calibration matrix of neighbor view
+        profiler -- optional Profiler, records the "warping" stage
     Output:
         warped_neighbor -- height x width x 3 array of the warped neighbor RGB image
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
 
     height, width = neighbor_rgb.shape[:2]
     
-    bp_c = backproject_fn(K_ref, width, height, depth, Rt_ref)
-    p_nei = project_fn(K_neighbor, Rt_neighbor, bp_c).reshape((-1,2))
-    p_ref = project_fn(K_ref, Rt_ref, bp_c).reshape((-1,2))
-    H, x = cv2.findHomography(p_nei, p_ref)
-    warped_neighbor = cv2.warpPerspective(neighbor_rgb, H, (width, height))
+    with profiler.stage("warping"):
+        bp_c = backproject_fn(K_ref, width, height, depth, Rt_ref)
+        p_nei = project_fn(K_neighbor, Rt_neighbor, bp_c).reshape((-1,2))
+        p_ref = project_fn(K_ref, Rt_ref, bp_c).reshape((-1,2))
+        H, x = cv2.findHomography(p_nei, p_ref)
+        warped_neighbor = cv2.warpPerspective(neighbor_rgb, H, (width, height))
     
     return warped_neighbor
 
@@ -132,12 +150,13 @@ def zncc_kernel_2D(src, dst):
     assert src.ndim == 4 and dst.ndim == 4
     assert src.shape[:] == dst.shape[:]
 
-
+    dtype = accum_dtype(src.dtype)
+    src, dst = src.astype(dtype, copy=False), dst.astype(dtype, copy=False)
     W_1 = np.mean(src, axis =2)
     W_2 = np.mean(dst, axis =2)
     sigma_W_1 = np.std(src, axis = 2)
     sigma_W_2 = np.std(dst, axis = 2)
-    ZNCC = np.zeros((src.shape[0],src.shape[1],src.shape[3]))
+    ZNCC = np.zeros((src.shape[0],src.shape[1],src.shape[3]), dtype=dtype)
     
     for i in range(src.shape[0]):
         for j in range(src.shape[1]):
@@ -156,25 +175,197 @@ def zncc_kernel_2D(src, dst):
     return zncc  # height x width
 
 
-def backproject(dep_map, K):
+def compute_confidence(volume):
+    """
+    Per-pixel confidence of the depth selected by the argmax across depth labels
+
+    Input:
+        volume -- height x width x num_depths cost volume, higher is better
+    Output:
+        confidence -- height x width array, margin between the best and the second best score
+    """
+    if volume.shape[2] < 2:
+        return np.zeros(volume.shape[:2], dtype=volume.dtype)
+    top2 = np.partition(volume, -2, axis=2)[:, :, -2:]
+    return top2[:, :, 1] - top2[:, :, 0]
+
+
+def plane_sweep(
+    ref_view,
+    neighbor_views,
+    depths,
+    k_size=5,
+    dtype=np.float64,
+    prune=False,
+    hsv_th=45,
+    hsv_close_ksize=11,
+    texture_th=0.0,
+    num_workers=2,
+    max_pending=2,
+    profiler=None,
+):
+    """
+    Sweep the imaginary depth plane across the candidate depths and build the ZNCC cost volume
+
+    For each depth, every neighbor view is warped into the reference view and its ZNCC cost map
+    against the reference view is summed; the depth map is the argmax across depth labels.
+
+    With prune, pixels outside the HSV mask of postprocess or whose reference patch has a summed
+    RGB std not above texture_th are skipped: their depth and confidence are 0. A pixel also stops
+    being matched at a depth once its score plus the ZNCC upper bound (3 * k_size**2) of each
+    remaining neighbor cannot beat its best score so far; that upper bound is stored instead, so
+    the argmax is unchanged and the confidence can only be lower.
+
+    Views without "rgb" (load_middlebury_data with load_images=False) are first decoded on
+    num_workers threads; this happens once, before the sweep, and does not overlap the scoring.
+    The neighbor views of the next max_pending depth planes are then warped on a thread pool while
+    the current plane is scored, see pipeline.prefetch.
+
+    Input:
+        ref_view -- dict with "rgb" (or "rgb_fn"), "K", "R", "T" of the reference view
+        neighbor_views -- list of dicts with "rgb" (or "rgb_fn"), "K", "R", "T" of the neighbors
+        depths -- num_depths array of candidate depths
+        k_size -- patch size used by image2patch
+        dtype -- precision of the patch buffers and the cost volume, see to_precision
+        prune -- skip background / low-texture pixels and pixels that can no longer improve
+        hsv_th, hsv_close_ksize -- parameters of compute_hsv_mask, used with prune
+        texture_th -- minimal summed RGB std of a reference patch, used with prune
+        num_workers -- threads decoding the views and warping the upcoming depth planes, 0 runs
+            inline
+        max_pending -- number of depth planes warped ahead of the one being scored
+        profiler -- optional Profiler, records the "decoding_wait", "patch_extraction", "warping",
+            "warping_wait" (see pipeline.prefetch), "kernel" and "argmax" stages, the number of
+            reference pixels processed, pixel / neighbor evaluations, pruned pixels and planes swept
+    Output:
+        depth_map -- height x width array of the selected depth per pixel
+        confidence -- height x width array, see compute_confidence
+        volume -- height x width x num_depths cost volume
+    """
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    # views loaded with load_images=False are decoded once, in parallel, before the sweep
+    ref_rgb, *neighbor_rgbs = prefetch(
+        load_rgb,
+        [ref_view, *neighbor_views],
+        num_workers,
+        num_workers,
+        profiler=profiler,
+        wait_stage="decoding_wait",
+    )
+    height, width = ref_rgb.shape[:2]
+
+    K_ref = ref_view["K"]
+    Rt_ref = np.hstack((ref_view["R"], np.expand_dims(ref_view["T"], axis=1)))
+
+    if prune:
+        pixel_mask = compute_hsv_mask(ref_rgb, hsv_th, hsv_close_ksize) > 0
+    else:
+        pixel_mask = np.ones((height, width), dtype=bool)
+    # patches are only extracted at the masked pixels, for the reference and every warped neighbor
+    rows, cols = np.nonzero(pixel_mask)
+    with profiler.stage("patch_extraction"):
+        ref_patches = image2patch_at(to_precision(ref_rgb, dtype), k_size, rows, cols)
+    if prune:
+        texture = np.std(ref_patches.astype(accum_dtype(dtype), copy=False), axis=1).sum(-1)
+        textured = texture > texture_th
+        rows, cols, ref_patches = rows[textured], cols[textured], ref_patches[textured]
+        pixel_mask[:] = False
+        pixel_mask[rows, cols] = True
+    profiler.count("pixels_processed", pixel_mask.sum())
+    profiler.count("pixels_masked_out", pixel_mask.size - pixel_mask.sum())
+    # N x 1 x K**2 x 3, zncc_kernel_2D runs on the masked pixels only
+    ref_patches = ref_patches[:, None]
+
+    # ZNCC of one channel is bounded by k_size**2, see zncc_kernel_2D
+    max_score = 3 * k_size**2
+    volume = np.zeros((height, width, len(depths)), dtype=accum_dtype(dtype))
+    profiler.track("cost_volume", volume)
+    best = np.full(ref_patches.shape[0], -np.inf, dtype=volume.dtype)
+
+    Rt_neighbors = [
+        np.hstack((view["R"], np.expand_dims(view["T"], axis=1))) for view in neighbor_views
+    ]
+
+    def warp_plane(depth):
+        return [
+            warp_neighbor_to_ref(
+                backproject_corners,
+                project_points,
+                depth,
+                neighbor_rgb,
+                K_ref,
+                Rt_ref,
+                neighbor_view["K"],
+                Rt_neighbor,
+                profiler=profiler,
+            )
+            for neighbor_view, neighbor_rgb, Rt_neighbor in zip(
+                neighbor_views, neighbor_rgbs, Rt_neighbors
+            )
+        ]
+
+    warped_planes = prefetch(
+        warp_plane, depths, num_workers, max_pending, profiler=profiler, wait_stage="warping_wait"
+    )
+    for d, warped_neighbors in enumerate(tqdm(warped_planes, total=len(depths))):
+        score = np.zeros(ref_patches.shape[0], dtype=volume.dtype)
+        alive = np.ones(ref_patches.shape[0], dtype=bool)
+        for n, warped_neighbor in enumerate(warped_neighbors):
+            with profiler.stage("patch_extraction"):
+                neighbor_patches = image2patch_at(
+                    to_precision(warped_neighbor, dtype), k_size, rows[alive], cols[alive]
+                )[:, None]
+            profiler.track("patches", ref_patches, neighbor_patches)
+            with profiler.stage("kernel"):
+                score[alive] += zncc_kernel_2D(ref_patches[alive], neighbor_patches)[:, 0]
+            profiler.count("pixel_neighbor_evaluations", alive.sum())
+
+            remaining = len(neighbor_views) - n - 1
+            if prune and remaining > 0:
+                pruned = alive & (score + remaining * max_score <= best)
+                score[pruned] += remaining * max_score
+                alive &= ~pruned
+                profiler.count("pixels_pruned", pruned.sum())
+        volume[pixel_mask, d] = score
+        best = np.maximum(best, score)
+        profiler.count("planes_swept")
+
+    with profiler.stage("argmax"):
+        vol_argmax = volume.argmax(axis=2)
+        depth_map = np.where(pixel_mask, np.asarray(depths)[vol_argmax], 0.0)
+        confidence = compute_confidence(volume)
+        confidence[~pixel_mask] = 0.0
+
+    return depth_map, confidence, volume
+
+
+def backproject(dep_map, K, dtype=np.float64, profiler=None):
     """
     Backproject image points to 3D coordinates wrt the camera frame according to the depth map
 
     Input:
         K -- camera intrinsics calibration matrix
         dep_map -- height x width array of depth values
+        dtype -- precision of the output points, uint8 is computed in float32
+        profiler -- optional Profiler, records the "backprojection" stage
     Output:
         points -- height x width x 3 array of 3D coordinates of backprojected points
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
+
     _u, _v = np.meshgrid(np.arange(dep_map.shape[1]), np.arange(dep_map.shape[0]))
 
     f = K[1,1] 
-    xyz_cam = np.zeros((dep_map.shape[0], dep_map.shape[1], 3))
-    for i in range(dep_map.shape[0]):
-        for j in range(dep_map.shape[1]):
-            caliberated_coord = np.linalg.inv(K)@np.array([j,i,1])
-            xyz_cam[i,j,0] =  caliberated_coord[0] * dep_map[i,j]
-            xyz_cam[i,j,1] = caliberated_coord[1] * dep_map[i,j]
-            xyz_cam[i,j,2] = caliberated_coord[2] * dep_map[i,j]
+    xyz_cam = np.zeros((dep_map.shape[0], dep_map.shape[1], 3), dtype=accum_dtype(dtype))
+    with profiler.stage("backprojection"):
+        for i in range(dep_map.shape[0]):
+            for j in range(dep_map.shape[1]):
+                caliberated_coord = np.linalg.inv(K)@np.array([j,i,1])
+                xyz_cam[i,j,0] =  caliberated_coord[0] * dep_map[i,j]
+                xyz_cam[i,j,1] = caliberated_coord[1] * dep_map[i,j]
+                xyz_cam[i,j,2] = caliberated_coord[2] * dep_map[i,j]
+    profiler.track("xyz_cam", xyz_cam)
            
     return xyz_cam
@@ -0,0 +1,96 @@
+import csv
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler:
+    """
+    Opt-in stage timers, counters and peak allocation tracker for the stereo pipelines
+
+    Usage:
+        profiler = Profiler()
+        two_view(view_i, view_j, 5, zncc_kernel, profiler=profiler)
+        profiler.save_json("two_view_profile.json")
+
+    Stages are accumulated by name (total seconds and number of calls), counters are summed,
+    and for every tracked name only the largest total nbytes seen is kept.
+    """
+
+    def __init__(self):
+        self.timings = {}  # name -> [total seconds, calls]
+        self.counters = {}  # name -> int
+        self.peak_bytes = {}  # name -> int
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                entry = self.timings.setdefault(name, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def track(self, name, *arrays):
+        """Record the total nbytes of arrays that are alive at the same time under name"""
+        nbytes = sum(int(array.nbytes) for array in arrays)
+        with self._lock:
+            self.peak_bytes[name] = max(self.peak_bytes.get(name, 0), nbytes)
+
+    def report(self):
+        """
+        Output:
+            report -- dict with "stages" (seconds, calls), "counters" and "peak_bytes"
+        """
+        with self._lock:
+            return {
+                "stages": {
+                    name: {"seconds": total, "calls": calls}
+                    for name, (total, calls) in self.timings.items()
+                },
+                "counters": dict(self.counters),
+                "peak_bytes": dict(self.peak_bytes),
+            }
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def save_csv(self, path):
+        """One row per entry: kind (stage / counter / peak_bytes), name, value, calls"""
+        report = self.report()
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["kind", "name", "value", "calls"])
+            for name, entry in report["stages"].items():
+                writer.writerow(["stage", name, entry["seconds"], entry["calls"]])
+            for name, value in report["counters"].items():
+                writer.writerow(["counter", name, value, ""])
+            for name, value in report["peak_bytes"].items():
+                writer.writerow(["peak_bytes", name, value, ""])
+
+
+class _NullProfiler:
+    """Default profiler, every hook is a no-op so uninstrumented runs pay almost nothing"""
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def count(self, name, n=1):
+        pass
+
+    def track(self, name, *arrays):
+        pass
+
+
+NULL_PROFILER = _NullProfiler()
@@ -0,0 +1,37 @@
+import threading
+import time
+
+import pytest
+
+from pipeline import prefetch
+from profiler import Profiler
+
+
+@pytest.mark.parametrize("max_pending", [0, 1, 2])
+def test_prefetch_keeps_at_most_max_pending_ahead(max_pending):
+    started = []
+    lock = threading.Lock()
+
+    def fn(item):
+        with lock:
+            started.append(item)
+        return item
+
+    results = []
+    for result in prefetch(fn, range(8), num_workers=4, max_pending=max_pending):
+        time.sleep(0.02)  # let every submitted item start
+        with lock:
+            assert max(started) - result <= max_pending
+        results.append(result)
+
+    assert results == list(range(8))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_prefetch_records_wait_stage(num_workers):
+    profiler = Profiler()
+
+    results = list(prefetch(lambda x: x * 2, range(5), num_workers, 1, profiler, "load_wait"))
+
+    assert results == [0, 2, 4, 6, 8]
+    assert profiler.report()["stages"]["load_wait"]["calls"] == 5
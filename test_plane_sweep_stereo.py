@@ -0,0 +1,83 @@
+import imageio
+import numpy as np
+
+from plane_sweep_stereo import plane_sweep
+from profiler import Profiler
+
+
+def test_prune_matches_full_sweep_on_kept_pixels():
+    rng = np.random.default_rng(0)
+    K = np.array([[100.0, 0.0, 12.0], [0.0, 100.0, 16.0], [0.0, 0.0, 1.0]])
+    views = []
+    for i in range(4):
+        rgb = (rng.random((32, 24, 3)) * 255).astype(np.uint8)
+        rgb[:12] = 0  # black background, masked out by the HSV mask
+        views.append({"rgb": rgb, "K": K, "R": np.eye(3), "T": np.array([0.01 * i, 0.0, 0.0])})
+    depths = np.linspace(0.5, 0.6, 5)
+
+    depth_full, confidence_full, _ = plane_sweep(views[0], views[1:], depths, 3)
+    profiler = Profiler()
+    depth, confidence, _ = plane_sweep(
+        views[0], views[1:], depths, 3, prune=True, hsv_close_ksize=3, profiler=profiler
+    )
+
+    kept = depth > 0
+    counters = profiler.report()["counters"]
+    assert not kept[:11].any() and kept[13:].all()
+    assert counters["pixels_processed"] == kept.sum()
+    assert np.array_equal(depth[kept], depth_full[kept])
+    assert (confidence[kept] <= confidence_full[kept] + 1e-9).all()
+    assert (confidence[~kept] == 0).all()
+
+
+def test_early_exit_keeps_the_full_sweep_depths():
+    # a fronto-parallel textured plane at depths[2] seen by cameras translated along x, so the
+    # neighbors align with the reference only at that depth and the other depths get pruned
+    rng = np.random.default_rng(0)
+    K = np.array([[100.0, 0.0, 40.0], [0.0, 100.0, 12.0], [0.0, 0.0, 1.0]])
+    depths = np.linspace(0.5, 0.6, 5)
+    rgb = rng.integers(60, 256, (24, 80, 3)).astype(np.uint8)
+    ref_view = {"rgb": rgb, "K": K, "R": np.eye(3), "T": np.zeros(3)}
+    # a translation of shift * depth / fx along x moves the plane by shift pixels
+    neighbor_views = [
+        {
+            "rgb": np.roll(rgb, shift, axis=1),
+            "K": K,
+            "R": np.eye(3),
+            "T": np.array([shift * depths[2] / K[0, 0], 0.0, 0.0]),
+        }
+        for shift in (4, 8, 12)
+    ]
+
+    depth_full, _, _ = plane_sweep(ref_view, neighbor_views, depths, 3)
+    profiler = Profiler()
+    depth, _, _ = plane_sweep(ref_view, neighbor_views, depths, 3, prune=True, profiler=profiler)
+
+    counters = profiler.report()["counters"]
+    assert counters["pixels_processed"] == rgb.shape[0] * rgb.shape[1]
+    assert counters["pixels_pruned"] > 0
+    assert counters["pixel_neighbor_evaluations"] < rgb.shape[0] * rgb.shape[1] * 3 * len(depths)
+    assert (depth_full == depths[2]).mean() > 0.9
+    assert np.array_equal(depth, depth_full)
+
+
+def test_lazy_views_match_loaded_views(tmp_path):
+    rng = np.random.default_rng(0)
+    K = np.array([[100.0, 0.0, 12.0], [0.0, 100.0, 16.0], [0.0, 0.0, 1.0]])
+    views, lazy_views = [], []
+    for i in range(3):
+        rgb = (rng.random((32, 24, 3)) * 255).astype(np.uint8)
+        rgb_fn = str(tmp_path / f"view{i}.png")
+        imageio.imwrite(rgb_fn, rgb)
+        camera = {"K": K, "R": np.eye(3), "T": np.array([0.01 * i, 0.0, 0.0])}
+        views.append({**camera, "rgb": rgb})
+        lazy_views.append({**camera, "rgb_fn": rgb_fn})
+    depths = np.linspace(0.5, 0.6, 5)
+
+    expected = plane_sweep(views[0], views[1:], depths, 3, num_workers=0)
+    profiler = Profiler()
+    outputs = plane_sweep(lazy_views[0], lazy_views[1:], depths, 3, profiler=profiler)
+
+    for output, expected_output in zip(outputs, expected):
+        assert np.array_equal(output, expected_output)
+    assert profiler.report()["stages"]["decoding_wait"]["calls"] == 3
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from plane_sweep_stereo import plane_sweep
+from two_view_stereo import (
+    compute_dep_and_pcl,
+    compute_disparity_map,
+    image2patch,
+    sad_kernel,
+    ssd_kernel,
+    to_precision,
+    zncc_kernel,
+)
+
+K_SIZE = 3
+D0 = 0.5
+SHIFT = 2
+
+
+@pytest.fixture(scope="module")
+def rectified_pair():
+    # the right view is the left view shifted up by SHIFT rows, so a left pixel v matches v - SHIFT
+    rng = np.random.default_rng(0)
+    rgb_i = (rng.random((24, 10, 3)) * 255).astype(np.uint8)
+    rgb_j = np.roll(rgb_i, -SHIFT, axis=0)
+    return rgb_i, rgb_j
+
+
+@pytest.fixture(scope="module")
+def view_set():
+    rng = np.random.default_rng(1)
+    K = np.array([[100.0, 0.0, 12.0], [0.0, 100.0, 16.0], [0.0, 0.0, 1.0]])
+    views = [
+        {
+            "rgb": (rng.random((32, 24, 3)) * 255).astype(np.uint8),
+            "K": K,
+            "R": np.eye(3),
+            "T": np.array([0.01 * i, 0.005 * i, 0.0]),
+        }
+        for i in range(3)
+    ]
+    return views[0], views[1:], np.linspace(0.5, 0.6, 5)
+
+
+@pytest.mark.parametrize("kernel_func", [ssd_kernel, sad_kernel, zncc_kernel])
+@pytest.mark.parametrize("dtype", [np.float32, np.uint8])
+def test_disparity_matches_float64(rectified_pair, kernel_func, dtype):
+    """
+    The disparity map equals the float64 one (max abs difference 0), except where the float64
+    costs of the two chosen candidates tie. SAD / SSD costs are sums of integers once scaled by
+    255, so two unrelated right patches can have exactly the same cost and the argmin between
+    them depends on the summation rounding; every differing pixel is checked to be such a tie.
+    """
+    rgb_i, rgb_j = rectified_pair
+    disp_64, _ = compute_disparity_map(rgb_i, rgb_j, D0, K_SIZE, kernel_func)
+    disp, _ = compute_disparity_map(rgb_i, rgb_j, D0, K_SIZE, kernel_func, dtype=dtype)
+
+    patches_i = image2patch(to_precision(rgb_i), K_SIZE)
+    patches_j = image2patch(to_precision(rgb_j), K_SIZE)
+    for v, u in zip(*np.nonzero(disp != disp_64)):
+        vj_64 = int(round(v + D0 - disp_64[v, u]))
+        vj = int(round(v + D0 - disp[v, u]))
+        cost = kernel_func(patches_i[v : v + 1, u], patches_j[[vj_64, vj], u])[0]
+        assert np.isclose(cost[0], cost[1], rtol=1e-5, atol=1e-6), (v, u)
+
+    # away from the zero padding and the wrapped rows, the matching right patch is identical
+    v = np.arange(rgb_i.shape[0])
+    matched = (v >= SHIFT + K_SIZE // 2) & (v < rgb_i.shape[0] - SHIFT - K_SIZE // 2)
+    assert np.abs(disp - disp_64)[matched].max() == 0.0
+    assert (disp_64[matched] == SHIFT + D0).all()
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.uint8])
+def test_depth_matches_float64(rectified_pair, dtype):
+    """Depth and points from the same disparity map are within float32 rounding of float64"""
+    rgb_i, rgb_j = rectified_pair
+    disp_64, _ = compute_disparity_map(rgb_i, rgb_j, D0, K_SIZE, ssd_kernel)
+    K = np.array([[100.0, 0.0, 5.0], [0.0, 100.0, 12.0], [0.0, 0.0, 1.0]])
+    dep_64, xyz_64 = compute_dep_and_pcl(disp_64, 0.1, K)
+    dep, xyz = compute_dep_and_pcl(disp_64, 0.1, K, dtype=dtype)
+
+    assert dep.dtype == np.float32 and xyz.dtype == np.float32
+    assert np.abs(dep - dep_64).max() <= 1e-6 * np.abs(dep_64).max()
+    assert np.abs(xyz - xyz_64).max() <= 1e-6 * np.abs(xyz_64).max()
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.uint8])
+def test_plane_sweep_matches_float64(view_set, dtype):
+    """
+    The ZNCC cost volume is within 1e-3 of the float64 one and the depth map is identical
+    (max abs difference 0) wherever the float64 best / second best margin exceeds that bound
+    """
+    ref_view, neighbor_views, depths = view_set
+    depth_64, confidence_64, volume_64 = plane_sweep(ref_view, neighbor_views, depths, K_SIZE)
+    depth, _, volume = plane_sweep(ref_view, neighbor_views, depths, K_SIZE, dtype=dtype)
+
+    assert volume.dtype == np.float32
+    assert np.abs(volume - volume_64).max() <= 1e-3
+    decided = confidence_64 > 2e-3
+    assert decided.mean() > 0.5
+    assert np.abs(depth - depth_64)[decided].max() == 0.0
@@ -0,0 +1,93 @@
+import csv
+import json
+
+import numpy as np
+
+from profiler import Profiler
+from two_view_stereo import compute_dep_and_pcl, compute_disparity_map, two_view, zncc_kernel
+
+
+def test_report_round_trips_through_json_and_csv(tmp_path):
+    profiler = Profiler()
+    with profiler.stage("kernel"):
+        pass
+    with profiler.stage("kernel"):
+        pass
+    profiler.count("pixels_processed", 6)
+    profiler.count("pixels_processed", 4)
+    profiler.track("patches", np.zeros(10), np.zeros(5))
+    profiler.track("patches", np.zeros(3))
+
+    report = profiler.report()
+    assert report["stages"]["kernel"]["calls"] == 2
+    assert report["counters"] == {"pixels_processed": 10}
+    assert report["peak_bytes"] == {"patches": 15 * 8}
+
+    profiler.save_json(tmp_path / "profile.json")
+    with open(tmp_path / "profile.json") as f:
+        assert json.load(f) == report
+
+    profiler.save_csv(tmp_path / "profile.csv")
+    with open(tmp_path / "profile.csv", newline="") as f:
+        rows = {(row["kind"], row["name"]): row for row in csv.DictReader(f)}
+    assert set(rows) == {
+        ("stage", "kernel"),
+        ("counter", "pixels_processed"),
+        ("peak_bytes", "patches"),
+    }
+    assert float(rows["stage", "kernel"]["value"]) == report["stages"]["kernel"]["seconds"]
+    assert rows["stage", "kernel"]["calls"] == "2"
+    assert rows["counter", "pixels_processed"]["value"] == "10"
+    assert rows["peak_bytes", "patches"]["value"] == "120"
+
+
+def test_disparity_and_depth_stages():
+    rng = np.random.default_rng(0)
+    rgb_i = (rng.random((12, 6, 3)) * 255).astype(np.uint8)
+    rgb_j = np.roll(rgb_i, -1, axis=0)
+    K = np.array([[100.0, 0.0, 3.0], [0.0, 100.0, 6.0], [0.0, 0.0, 1.0]])
+    profiler = Profiler()
+
+    disp_map, _ = compute_disparity_map(rgb_i, rgb_j, 0.5, 3, zncc_kernel, profiler=profiler)
+    compute_dep_and_pcl(disp_map, 0.1, K, profiler=profiler)
+
+    report = profiler.report()
+    assert set(report["stages"]) == {
+        "patch_extraction",
+        "kernel",
+        "argmin_lr_check",
+        "backprojection",
+    }
+    assert report["stages"]["kernel"]["calls"] == 6  # one per column
+    assert report["counters"] == {"pixels_processed": 12 * 6}
+    # both [12,6,9,3] float64 patch buffers are alive together
+    assert report["peak_bytes"]["patches"] == 2 * 12 * 6 * 9 * 3 * 8
+
+
+def test_two_view_records_every_stage():
+    rng = np.random.default_rng(0)
+    K = np.array([[100.0, 0.0, 40.0], [0.0, 100.0, 40.0], [0.0, 0.0, 1.0]])
+    views = [
+        {
+            "rgb": (rng.random((80, 80, 3)) * 255).astype(np.uint8),
+            "K": K,
+            "R": np.eye(3),
+            "T": np.array([0.0, -0.01 * i, 0.0]),
+        }
+        for i in range(2)
+    ]
+    profiler = Profiler()
+
+    two_view(views[0], views[1], 3, zncc_kernel, profiler=profiler)
+
+    report = profiler.report()
+    assert set(report["stages"]) == {
+        "rectification",
+        "patch_extraction",
+        "kernel",
+        "argmin_lr_check",
+        "backprojection",
+        "outlier_removal",
+    }
+    assert set(report["counters"]) == {"pixels_processed", "points_kept"}
+    assert set(report["peak_bytes"]) == {"patches", "cost_matrix", "xyz_cam"}
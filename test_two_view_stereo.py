@@ -0,0 +1,42 @@
+import imageio
+import numpy as np
+import pytest
+
+from two_view_stereo import image2patch, image2patch_at, two_view_pairs
+
+
+@pytest.mark.parametrize("k_size", [1, 3, 5])
+@pytest.mark.parametrize("dtype", [np.float64, np.uint8])
+def test_image2patch_at_matches_image2patch(k_size, dtype):
+    rng = np.random.default_rng(0)
+    image = (rng.random((12, 9, 3)) * 255).astype(dtype)
+    rows, cols = np.nonzero(rng.random((12, 9)) > 0.5)
+
+    patches = image2patch_at(image, k_size, rows, cols)
+
+    assert patches.dtype == image.dtype
+    assert np.array_equal(patches, image2patch(image, k_size)[rows, cols])
+
+
+def test_two_view_pairs_threaded_matches_inline(tmp_path):
+    rng = np.random.default_rng(0)
+    K = np.array([[100.0, 0.0, 40.0], [0.0, 100.0, 40.0], [0.0, 0.0, 1.0]])
+    DATA, lazy_DATA = [], []
+    for i in range(4):
+        rgb = (rng.random((80, 80, 3)) * 255).astype(np.uint8)
+        rgb_fn = str(tmp_path / f"view{i}.png")
+        imageio.imwrite(rgb_fn, rgb)
+        # each view is on the left of the next one, as two_view assumes
+        camera = {"K": K, "R": np.eye(3), "T": np.array([0.0, -0.01 * i, 0.0])}
+        DATA.append({**camera, "rgb": rgb})
+        lazy_DATA.append({**camera, "rgb_fn": rgb_fn})
+    pairs = [(0, 1), (1, 2), (2, 3), (0, 2)]
+
+    expected = list(two_view_pairs(DATA, pairs, k_size=3, num_workers=0))
+    # a generator of pairs is consumed only once
+    outputs = list(two_view_pairs(lazy_DATA, (pair for pair in pairs), k_size=3, num_workers=2))
+
+    assert len(outputs) == len(pairs)
+    for output, expected_output in zip(outputs, expected):
+        for array, expected_array in zip(output, expected_output):
+            assert np.array_equal(array, expected_array, equal_nan=True)
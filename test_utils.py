@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+
+# utils imports pyrender, which fails to import when PYOPENGL_PLATFORM names a missing GL library
+try:
+    import pyrender
+except ImportError as e:
+    pytest.skip(f"pyrender cannot be imported ({e!r})", allow_module_level=True)
+
+from utils import add_frustums, build_lod, render_reconstruction, select_lod, voxel_downsample
+
+
+K = np.array([[100.0, 0.0, 8.0], [0.0, 100.0, 12.0], [0.0, 0.0, 1.0]])
+DATA = [
+    {"K": K, "R": np.eye(3), "T": np.array([0.01 * i, 0.0, 0.3]), "rgb": np.zeros((24, 16, 3))}
+    for i in range(3)
+]
+
+
+@pytest.fixture(scope="module")
+def offscreen_gl():
+    try:
+        renderer = pyrender.OffscreenRenderer(8, 8)
+    except Exception as e:
+        pytest.skip(f"no offscreen GL platform, set PYOPENGL_PLATFORM=osmesa or egl ({e!r})")
+    renderer.delete()
+
+
+def test_add_frustums_is_instanced():
+    # building the scene does not need a GL context
+    scene = add_frustums(pyrender.Scene(), DATA)
+
+    (mesh,) = scene.meshes
+    (primitive,) = mesh.primitives
+    assert primitive.mode == pyrender.constants.GLTF.LINES
+    assert primitive.positions.shape == (16, 3)
+    assert primitive.poses.shape == (3, 4, 4)
+    assert np.allclose(primitive.poses[:, :3, 3], [[-0.01 * i, 0.0, -0.3] for i in range(3)])
+
+
+def test_add_frustums_groups_views_by_intrinsics():
+    K_wide = K * np.array([[0.5], [0.5], [1.0]])
+    views = DATA + [
+        {"K": K_wide, "R": np.eye(3), "T": np.zeros(3), "rgb": np.zeros((24, 16, 3))},
+        {"K": K, "R": np.eye(3), "T": np.zeros(3), "rgb": np.zeros((64, 40, 3))},
+    ]
+
+    scene = add_frustums(pyrender.Scene(), views, scale=1.0)
+
+    (mesh,) = scene.meshes
+    assert [p.poses.shape[0] for p in mesh.primitives] == [3, 1, 1]
+    # the far corner of each frustum is inv(K) @ (width, height, 1) of its own view
+    far_corners = [p.positions[7] for p in mesh.primitives]
+    assert np.allclose(far_corners[0], [0.08, 0.12, 1.0])
+    assert np.allclose(far_corners[1], [0.24, 0.36, 1.0])
+    assert np.allclose(far_corners[2], [0.32, 0.52, 1.0])
+
+
+def test_render_reconstruction(offscreen_gl, tmp_path):
+    rng = np.random.default_rng(0)
+    pcl = rng.random((5000, 3)) * 0.1
+    color = np.full((5000, 3), 255, dtype=np.uint8)
+
+    image = render_reconstruction(
+        str(tmp_path / "render.png"), pcl, color, DATA=DATA, max_points=1000, size=(64, 48)
+    )
+
+    assert image.shape == (48, 64, 3)
+    assert image.max() > 0
+    assert (tmp_path / "render.png").exists()
+
+
+def test_build_lod_fits_budget():
+    # a volumetric cloud barely shrinks at the finest voxel sizes, levels are added until it fits
+    rng = np.random.default_rng(0)
+    pcl = rng.random((200000, 3))
+    color = (rng.random((200000, 3)) * 255).astype(np.uint8)
+
+    lod = build_lod(pcl, color, np.sqrt(3) / 1000.0, max_points=5000)
+
+    assert lod[0][0].shape[0] == 200000
+    assert lod[-1][0].shape[0] <= 5000
+    assert all(level[0].shape[0] > 5000 for level in lod[:-1])
+    assert select_lod(lod, 5000)[0] is lod[-1][0]
+
+
+@pytest.mark.parametrize("n_points", [0, 1, 10])
+def test_voxel_downsample_degenerate_clouds(n_points):
+    pcl = np.ones((n_points, 3))
+    color = np.full((n_points, 3), 128, dtype=np.uint8)
+
+    pcl_down, color_down = voxel_downsample(pcl, color, 0.01)
+
+    assert pcl_down.shape == (min(n_points, 1), 3)
+    assert color_down.dtype == np.uint8
+
+
+@pytest.mark.parametrize("voxel_size", [0.0, -1.0, np.nan])
+def test_build_lod_rejects_non_positive_voxel_size(voxel_size):
+    pcl = np.random.default_rng(0).random((1000, 3))
+    color = np.zeros((1000, 3), dtype=np.uint8)
+
+    with pytest.raises(AssertionError):
+        build_lod(pcl, color, voxel_size, max_points=100)
+    with pytest.raises(AssertionError):
+        voxel_downsample(pcl, color, voxel_size)
+
+
+def test_voxel_downsample_tiny_voxels():
+    # a voxel size far below the extent is clamped instead of overflowing the flat voxel index
+    pcl = np.array([[0.0, 0.0, 0.0], [1.0, 1.0, 1.0], [1.0, 1.0, 1.0]])
+    color = np.zeros((3, 3), dtype=np.uint8)
+
+    pcl_down, _ = voxel_downsample(pcl, color, 1e-12)
+
+    assert pcl_down.shape == (2, 3)
@@ -11,13 +11,40 @@ import cv2
 import open3d as o3d
 
 
-from dataloader import load_middlebury_data
+from dataloader import load_middlebury_data, load_rgb
+from pipeline import prefetch
+from profiler import NULL_PROFILER
 
 # from utils import viz_camera_poses
 
 EPS = 1e-8
 
 
+def to_precision(rgb, dtype=np.float64):
+    """Convert a uint8 rgb image to the compute precision
+
+    Parameters
+    ----------
+    rgb : [H,W,3], uint8
+    dtype : np.float64, np.float32 or np.uint8, optional
+        float dtypes are scaled to [0,1]; np.uint8 keeps the raw 0-255 values, which only scales
+        the SSD/SAD costs and leaves ZNCC unchanged, by default np.float64
+
+    Returns
+    -------
+    [H,W,3]
+        the image in the requested dtype
+    """
+    if np.dtype(dtype) == np.uint8:
+        return rgb.astype(np.uint8, copy=False)
+    return rgb.astype(dtype) / 255.0
+
+
+def accum_dtype(dtype):
+    """The float dtype used to accumulate kernel scores, float32 for uint8 / float32 inputs"""
+    return np.promote_types(dtype, np.float32)
+
+
 def homo_corners(h, w, H):
     corners_bef = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
     corners_aft = cv2.perspectiveTransform(corners_bef, H).squeeze(1)
@@ -26,7 +53,9 @@ def homo_corners(h, w, H):
     return u_min, u_max, v_min, v_max
 
 
-def rectify_2view(rgb_i, rgb_j, R_irect, R_jrect, K_i, K_j, u_padding=20, v_padding=20):
+def rectify_2view(
+    rgb_i, rgb_j, R_irect, R_jrect, K_i, K_j, u_padding=20, v_padding=20, profiler=None
+):
     """Given the rectify rotation, compute the rectified view and corrected projection matrix
 
     Parameters
@@ -39,6 +68,8 @@ def rectify_2view(rgb_i, rgb_j, R_irect, R_jrect, K_i, K_j, u_padding=20, v_padd
         original camera matrix
     u_padding,v_padding : int, optional
         padding the border to remove the blank space, by default 20
+    profiler : Profiler, optional
+        records the "rectification" stage, by default no profiling
 
     Returns
     -------
@@ -47,6 +78,8 @@ def rectify_2view(rgb_i, rgb_j, R_irect, R_jrect, K_i, K_j, u_padding=20, v_padd
         the corrected camera projection matrix. WE HELP YOU TO COMPUTE K, YOU DON'T NEED TO CHANGE THIS
     """
     # reference: https://stackoverflow.com/questions/18122444/opencv-warpperspective-how-to-know-destination-image-size
+    if profiler is None:
+        profiler = NULL_PROFILER
     assert rgb_i.shape == rgb_j.shape, "This hw assumes the input images are in same size"
     h, w = rgb_i.shape[:2]
 
@@ -64,10 +97,11 @@ def rectify_2view(rgb_i, rgb_j, R_irect, R_jrect, K_i, K_j, u_padding=20, v_padd
     K_j_corr[0, 2] -= u_padding
     K_j_corr[1, 2] -= vj_min + v_padding
 
-    H = K_i_corr @ R_irect @ np.linalg.inv(K_i)
-    rgb_i_rect = cv2.warpPerspective(rgb_i, H, (w_max, h_max))
-    H2 = K_j_corr @ R_jrect @ np.linalg.inv(K_j)
-    rgb_j_rect = cv2.warpPerspective(rgb_j, H2, (w_max, h_max))
+    with profiler.stage("rectification"):
+        H = K_i_corr @ R_irect @ np.linalg.inv(K_i)
+        rgb_i_rect = cv2.warpPerspective(rgb_i, H, (w_max, h_max))
+        H2 = K_j_corr @ R_jrect @ np.linalg.inv(K_j)
+        rgb_j_rect = cv2.warpPerspective(rgb_j, H2, (w_max, h_max))
 
     return rgb_i_rect, rgb_j_rect, K_i_corr, K_j_corr
 
@@ -142,7 +176,9 @@ def ssd_kernel(src, dst):
     assert src.ndim == 3 and dst.ndim == 3
     assert src.shape[1:] == dst.shape[1:]
 
-    SSD = np.empty((src.shape[0], dst.shape[0], src.shape[2]))
+    dtype = accum_dtype(src.dtype)
+    src, dst = src.astype(dtype, copy=False), dst.astype(dtype, copy=False)
+    SSD = np.empty((src.shape[0], dst.shape[0], src.shape[2]), dtype=dtype)
     
     for i in range(src.shape[0]):
         for j in range(dst.shape[0]):
@@ -174,7 +210,9 @@ def sad_kernel(src, dst):
     assert src.ndim == 3 and dst.ndim == 3
     assert src.shape[1:] == dst.shape[1:]
 
-    Sad = np.empty((src.shape[0], dst.shape[0], src.shape[2]))
+    dtype = accum_dtype(src.dtype)
+    src, dst = src.astype(dtype, copy=False), dst.astype(dtype, copy=False)
+    Sad = np.empty((src.shape[0], dst.shape[0], src.shape[2]), dtype=dtype)
     
 
     for i in range(src.shape[0]):
@@ -207,12 +245,14 @@ def zncc_kernel(src, dst):
     assert src.ndim == 3 and dst.ndim == 3
     assert src.shape[1:] == dst.shape[1:]
 
+    dtype = accum_dtype(src.dtype)
+    src, dst = src.astype(dtype, copy=False), dst.astype(dtype, copy=False)
     W_1 = np.mean(src, axis =1)
     W_2 = np.mean(dst, axis =1)
     sigma_W_1 = np.std(src, axis = 1)
     sigma_W_2 = np.std(dst, axis = 1)
 
-    ZNCC = np.zeros((src.shape[0], dst.shape[0], src.shape[2]))
+    ZNCC = np.zeros((src.shape[0], dst.shape[0], src.shape[2]), dtype=dtype)
     
     for i in range(src.shape[0]):
         for j in range(dst.shape[0]):
@@ -241,7 +281,7 @@ def image2patch(image, k_size):
     Returns
     -------
     [H,W,k_size**2,3]
-        The patch buffer for each pixel
+        The patch buffer for each pixel, in the same dtype as image
     """
 
     # patch_buffer = np.zeros((image.shape[0], image.shape[1], k_size**2, 3))
@@ -254,9 +294,9 @@ def image2patch(image, k_size):
     r =  np.pad(image[:,:,2], a, mode='constant')
     padded = np.dstack ((p,q,r))
     
-    pixel_patches1= np.zeros((image.shape[0], image.shape[1],k_size**2))
-    pixel_patches2 = np.zeros((image.shape[0], image.shape[1],k_size**2))
-    pixel_patches3 = np.zeros((image.shape[0], image.shape[1],k_size**2))
+    pixel_patches1= np.zeros((image.shape[0], image.shape[1],k_size**2), dtype=image.dtype)
+    pixel_patches2 = np.zeros((image.shape[0], image.shape[1],k_size**2), dtype=image.dtype)
+    pixel_patches3 = np.zeros((image.shape[0], image.shape[1],k_size**2), dtype=image.dtype)
 
     for i in range(a, padded.shape[0]- a):
         for j in range(a, padded.shape[1]- a):
@@ -268,8 +308,36 @@ def image2patch(image, k_size):
     return patch_buffer  # H,W,K**2,3
 
 
+def image2patch_at(image, k_size, rows, cols):
+    """get the patch buffer of image2patch at the given pixel locations only, with zero padding
+
+    Parameters
+    ----------
+    image : [H,W,3]
+    k_size : int, must be odd number
+    rows,cols : [N], int
+        pixel locations
+
+    Returns
+    -------
+    [N,k_size**2,3]
+        The patch buffer for each location, same values and dtype as image2patch(image, k_size)[rows, cols]
+    """
+    a = k_size // 2
+    padded = np.pad(image, ((a, a), (a, a), (0, 0)), mode='constant')
+    dv, du = np.meshgrid(np.arange(k_size), np.arange(k_size), indexing='ij')
+    return padded[rows[:, None] + dv.reshape(-1), cols[:, None] + du.reshape(-1)]  # N,K**2,3
+
+
 def compute_disparity_map(
-    rgb_i, rgb_j, d0, k_size=5, kernel_func=ssd_kernel, img2patch_func=image2patch
+    rgb_i,
+    rgb_j,
+    d0,
+    k_size=5,
+    kernel_func=ssd_kernel,
+    img2patch_func=image2patch,
+    dtype=np.float64,
+    profiler=None,
 ):
     """Compute the disparity map from two rectified view
 
@@ -283,6 +351,11 @@ def compute_disparity_map(
         the kernel used to compute the patch similarity, by default ssd_kernel
     img2patch_func : function, optional
         
+    dtype : np.float64, np.float32 or np.uint8, optional
+        precision of the patch buffers and kernel scores, see to_precision, by default np.float64
+    profiler : Profiler, optional
+        records the "patch_extraction", "kernel" and "argmin_lr_check" stages, by default no profiling
+
     Returns
     -------
     disp_map: [H,W], dtype=np.float64
@@ -291,13 +364,18 @@ def compute_disparity_map(
     lr_consistency_mask: [H,W], dtype=np.float64
         For each pixel, 1.0 if LR consistent, otherwise 0.0
     """
-    
+    if profiler is None:
+        profiler = NULL_PROFILER
+
     h, w = rgb_i.shape[:2]
     disp_map = np.zeros((h,w), dtype = np.float64)
     lr_consistency_mask = np.zeros((h,w), dtype = np.float64)
 
-    patches_i = image2patch(rgb_i.astype(float) / 255.0, k_size)  # [h,w,k*k,3]
-    patches_j = image2patch(rgb_j.astype(float) / 255.0, k_size)  # [h,w,k*k,3]
+    with profiler.stage("patch_extraction"):
+        patches_i = image2patch(to_precision(rgb_i, dtype), k_size)  # [h,w,k*k,3]
+        patches_j = image2patch(to_precision(rgb_j, dtype), k_size)  # [h,w,k*k,3]
+    profiler.track("patches", patches_i, patches_j)
+    profiler.count("pixels_processed", h * w)
 
     vi_idx, vj_idx = np.arange(h), np.arange(h)
     disp_candidates = vi_idx[:, None] - vj_idx[None, :] + d0
@@ -305,20 +383,23 @@ def compute_disparity_map(
 
     for u in range(w):
         buf_i, buf_j = patches_i[:, u], patches_j[:, u]
-        value = kernel_func(buf_i, buf_j)  
-        _upper = value.max() + 1.0
-        value[~valid_disp_mask] = _upper
-        for v in range(h):
-            best_matched_right_pixel = value[v].argmin()
-            best_matched_left_pixel = value[:,best_matched_right_pixel].argmin()
-            consistent_flag = best_matched_left_pixel == v
-            disp_map[v,u] = disp_candidates[v, best_matched_right_pixel]
-            lr_consistency_mask[v,u] = consistent_flag
+        with profiler.stage("kernel"):
+            value = kernel_func(buf_i, buf_j)  
+        profiler.track("cost_matrix", value)
+        with profiler.stage("argmin_lr_check"):
+            _upper = value.max() + 1.0
+            value[~valid_disp_mask] = _upper
+            for v in range(h):
+                best_matched_right_pixel = value[v].argmin()
+                best_matched_left_pixel = value[:,best_matched_right_pixel].argmin()
+                consistent_flag = best_matched_left_pixel == v
+                disp_map[v,u] = disp_candidates[v, best_matched_right_pixel]
+                lr_consistency_mask[v,u] = consistent_flag
 
     return disp_map, lr_consistency_mask
 
 
-def compute_dep_and_pcl(disp_map, B, K):
+def compute_dep_and_pcl(disp_map, B, K, dtype=np.float64, profiler=None):
     """Given disparity map d = d0 + vL - vR, the baseline and the camera matrix K
     compute the depth map and backprojected point cloud
 
@@ -330,6 +411,10 @@ def compute_dep_and_pcl(disp_map, B, K):
         baseline
     K : [3,3]
         camera matrix
+    dtype : optional
+        precision of dep_map and xyz_cam, uint8 is computed in float32, by default np.float64
+    profiler : Profiler, optional
+        records the "backprojection" stage, by default no profiling
 
     Returns
     -------
@@ -338,19 +423,50 @@ def compute_dep_and_pcl(disp_map, B, K):
     [H,W,3]
         each pixel is the xyz coordinate of the back projected point cloud in camera frame
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
+
+    dtype = accum_dtype(dtype)
     f = K[1,1] 
-    xyz_cam = np.zeros((disp_map.shape[0], disp_map.shape[1], 3))
-    dep_map = (f*B)*np.reciprocal(disp_map)
-    for i in range(disp_map.shape[0]):
-        for j in range(disp_map.shape[1]):
-            caliberated_coord = np.linalg.inv(K)@np.array([j,i,1])
-            x = (caliberated_coord[0]/caliberated_coord[2]) * dep_map[i,j]
-            y = (caliberated_coord[1]/caliberated_coord[2]) * dep_map[i,j]
-            xyz_cam[i,j] = [x, y, dep_map[i,j]]    
+    xyz_cam = np.zeros((disp_map.shape[0], disp_map.shape[1], 3), dtype=dtype)
+    with profiler.stage("backprojection"):
+        dep_map = ((f*B)*np.reciprocal(disp_map)).astype(dtype)
+        for i in range(disp_map.shape[0]):
+            for j in range(disp_map.shape[1]):
+                caliberated_coord = np.linalg.inv(K)@np.array([j,i,1])
+                x = (caliberated_coord[0]/caliberated_coord[2]) * dep_map[i,j]
+                y = (caliberated_coord[1]/caliberated_coord[2]) * dep_map[i,j]
+                xyz_cam[i,j] = [x, y, dep_map[i,j]]    
+    profiler.track("xyz_cam", xyz_cam)
             
     return dep_map, xyz_cam
 
 
+def compute_hsv_mask(rgb, hsv_th=45, hsv_close_ksize=11):
+    """Foreground mask from the HSV value channel, closed to fill small holes
+
+    Parameters
+    ----------
+    rgb : [H,W,3], uint8
+    hsv_th : int, optional
+        pixels with a value channel above hsv_th are foreground, by default 45
+    hsv_close_ksize : int, optional
+        size of the elliptic closing kernel, by default 11
+
+    Returns
+    -------
+    [H,W], dtype=float
+        255.0 on the foreground, 0.0 on the background
+    """
+    mask_hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)[..., -1]
+    mask_hsv = (mask_hsv > hsv_th).astype(np.uint8) * 255
+    # imageio.imsave("./debug_hsv_mask.png", mask_hsv)
+    morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (hsv_close_ksize, hsv_close_ksize))
+    mask_hsv = cv2.morphologyEx(mask_hsv, cv2.MORPH_CLOSE, morph_kernel).astype(float)
+    # imageio.imsave("./debug_hsv_mask_closed.png", mask_hsv)
+    return mask_hsv
+
+
 def postprocess(
     dep_map,
     rgb,
@@ -362,19 +478,19 @@ def postprocess(
     hsv_close_ksize=11,
     z_near=0.45,
     z_far=0.65,
+    profiler=None,
 ):
     """
     given pcl_cam [N,3], R_wc [3,3] and T_wc [3,1]
     compute the pcl_world with shape[N,3] in the world coordinate
+
+    profiler records the "outlier_removal" stage and the number of points kept
     """
+    if profiler is None:
+        profiler = NULL_PROFILER
 
     # extract mask from rgb to remove background
-    mask_hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)[..., -1]
-    mask_hsv = (mask_hsv > hsv_th).astype(np.uint8) * 255
-    # imageio.imsave("./debug_hsv_mask.png", mask_hsv)
-    morph_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (hsv_close_ksize, hsv_close_ksize))
-    mask_hsv = cv2.morphologyEx(mask_hsv, cv2.MORPH_CLOSE, morph_kernel).astype(float)
-    # imageio.imsave("./debug_hsv_mask_closed.png", mask_hsv)
+    mask_hsv = compute_hsv_mask(rgb, hsv_th, hsv_close_ksize)
 
     # constraint z-near, z-far
     mask_dep = ((dep_map > z_near) * (dep_map < z_far)).astype(float)
@@ -387,9 +503,10 @@ def postprocess(
 
     # filter xyz point cloud
     pcl_cam = xyz_cam.reshape(-1, 3)[mask.reshape(-1) > 0]
-    o3d_pcd = o3d.geometry.PointCloud()
-    o3d_pcd.points = o3d.utility.Vector3dVector(pcl_cam.reshape(-1, 3).copy())
-    cl, ind = o3d_pcd.remove_statistical_outlier(nb_neighbors=10, std_ratio=2.0)
+    with profiler.stage("outlier_removal"):
+        o3d_pcd = o3d.geometry.PointCloud()
+        o3d_pcd.points = o3d.utility.Vector3dVector(pcl_cam.reshape(-1, 3).copy())
+        cl, ind = o3d_pcd.remove_statistical_outlier(nb_neighbors=10, std_ratio=2.0)
     _pcl_mask = np.zeros(pcl_cam.shape[0])
     _pcl_mask[ind] = 1.0
     pcl_mask = np.zeros(xyz_cam.shape[0] * xyz_cam.shape[1])
@@ -401,10 +518,8 @@ def postprocess(
 
     pcl_cam = xyz_cam.reshape(-1, 3)[mask.reshape(-1) > 0]
     pcl_color = rgb.reshape(-1, 3)[mask.reshape(-1) > 0]
+    profiler.count("points_kept", pcl_cam.shape[0])
 
-    print(R_wc.shape)
-    print(pcl_cam.shape)
-    print(T_wc.shape)
     pworld_cl = np.matmul(R_wc.T,( pcl_cam.T - T_wc))
     pcl_world =pworld_cl.T
    
@@ -414,9 +529,7 @@ def postprocess(
     return mask, pcl_world, pcl_cam, pcl_color
 
 
-def two_view(view_i, view_j, k_size=5, kernel_func=ssd_kernel):
-    # Full pipeline
-
+def _rectify_pair(view_i, view_j, profiler=None):
     # * 1. rectify the views
     R_wi, T_wi = view_i["R"], view_i["T"][:, None]  # p_i = R_wi @ p_w + T_wi
     R_wj, T_wj = view_j["R"], view_j["T"][:, None]  # p_j = R_wj @ p_w + T_wj
@@ -427,15 +540,24 @@ def two_view(view_i, view_j, k_size=5, kernel_func=ssd_kernel):
     R_irect = compute_rectification_R(T_ji)
 
     rgb_i_rect, rgb_j_rect, K_i_corr, K_j_corr = rectify_2view(
-        view_i["rgb"],
-        view_j["rgb"],
+        load_rgb(view_i),
+        load_rgb(view_j),
         R_irect,
         R_irect @ R_ji,
         view_i["K"],
         view_j["K"],
         u_padding=20,
         v_padding=20,
+        profiler=profiler,
     )
+    return rgb_i_rect, rgb_j_rect, K_i_corr, K_j_corr, R_irect, B
+
+
+def _reconstruct_rectified(
+    view_i, rectified, k_size=5, kernel_func=ssd_kernel, dtype=np.float64, profiler=None
+):
+    rgb_i_rect, rgb_j_rect, K_i_corr, K_j_corr, R_irect, B = rectified
+    R_wi, T_wi = view_i["R"], view_i["T"][:, None]  # p_i = R_wi @ p_w + T_wi
 
     # * 2. compute disparity
     assert K_i_corr[1, 1] == K_j_corr[1, 1], "This hw assumes the same focal Y length"
@@ -449,9 +571,11 @@ def two_view(view_i, view_j, k_size=5, kernel_func=ssd_kernel):
         d0=K_j_corr[1, 2] - K_i_corr[1, 2],
         k_size=k_size,
         kernel_func=kernel_func,
+        dtype=dtype,
+        profiler=profiler,
     )
     # * 3. compute depth map and filter them
-    dep_map, xyz_cam = compute_dep_and_pcl(disp_map, B, K_i_corr)
+    dep_map, xyz_cam = compute_dep_and_pcl(disp_map, B, K_i_corr, dtype=dtype, profiler=profiler)
     mask, pcl_world, pcl_cam, pcl_color = postprocess(
         dep_map,
         rgb_i_rect,
@@ -461,11 +585,64 @@ def two_view(view_i, view_j, k_size=5, kernel_func=ssd_kernel):
         consistency_mask=consistency_mask,
         z_near=0.5,
         z_far=0.6,
+        profiler=profiler,
     )
 
     return pcl_world, pcl_color, disp_map, dep_map
 
 
+def two_view(view_i, view_j, k_size=5, kernel_func=ssd_kernel, dtype=np.float64, profiler=None):
+    # Full pipeline, pass a profiler.Profiler to get the per-stage timing report
+    # dtype=np.float32 or np.uint8 cuts the memory traffic of the patch buffers, see to_precision
+    rectified = _rectify_pair(view_i, view_j, profiler=profiler)
+    return _reconstruct_rectified(view_i, rectified, k_size, kernel_func, dtype, profiler)
+
+
+def two_view_pairs(
+    DATA,
+    pairs,
+    k_size=5,
+    kernel_func=ssd_kernel,
+    dtype=np.float64,
+    num_workers=2,
+    max_pending=2,
+    profiler=None,
+):
+    """Run two_view on every (i, j) pair of DATA, decoding and rectifying the next pairs on a
+    thread pool while the current one is matched
+
+    Parameters
+    ----------
+    DATA : list of views, see load_middlebury_data
+        views loaded with load_images=False are decoded on the pool, see load_rgb
+    pairs : iterable of (i, j)
+        view i is the left view, view j the right view
+    k_size, kernel_func, dtype, profiler : see two_view
+        the profiler also records "rectification_wait", see pipeline.prefetch
+    num_workers : int, optional
+        threads decoding and rectifying the upcoming pairs, 0 runs inline, by default 2
+    max_pending : int, optional
+        number of pairs prepared ahead of the one being matched, by default 2
+
+    Yields
+    -------
+    pcl_world, pcl_color, disp_map, dep_map
+        the two_view outputs of each pair, in the order of pairs
+    """
+    # pairs is walked twice, by the prefetching pool and by the matching loop below
+    pairs = list(pairs)
+    rectified_pairs = prefetch(
+        lambda pair: _rectify_pair(DATA[pair[0]], DATA[pair[1]], profiler=profiler),
+        pairs,
+        num_workers,
+        max_pending,
+        profiler=profiler,
+        wait_stage="rectification_wait",
+    )
+    for (i, j), rectified in zip(pairs, rectified_pairs):
+        yield _reconstruct_rectified(DATA[i], rectified, k_size, kernel_func, dtype, profiler)
+
+
 def main():
     DATA = load_middlebury_data("data/templeRing")
     # viz_camera_poses(DATA)
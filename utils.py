@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import os.path as osp
+import warnings
 import imageio
 from tqdm import tqdm
 from transforms3d.euler import mat2euler, euler2mat
@@ -50,10 +51,236 @@ def add_coordinate(scene, R, T, axis_len=0.05, sections=6, ratio=20):
     return scene
 
 
-def viz_camera_poses(DATA):
-    scene = pyrender.Scene()
+def camera_to_world_poses(DATA):
+    """
+    Input:
+        DATA -- list of views with "R" and "T", p_cam = R @ p_w + T
+    Output:
+        poses -- N x 4 x 4 camera to world transforms
+    """
+    poses = np.tile(np.eye(4), (len(DATA), 1, 1))
+    for i, data in enumerate(DATA):
+        poses[i, :3, :3] = data["R"].T
+        poses[i, :3, 3] = -(data["R"].T @ data["T"][:, None])[:, 0]
+    return poses
+
+
+def add_coordinates(scene, poses, axis_len=0.05, sections=6, ratio=20):
+    """
+    Instanced version of add_coordinate, each axis cylinder is built once and drawn at every pose
+
+    Input:
+        scene -- pyrender.Scene
+        poses -- N x 4 x 4 camera to world transforms
+    Output:
+        scene -- the same scene with 3 instanced meshes added
+    """
+    _trans_x = np.eye(4)
+    _trans_x[:3, :3] = euler2mat(0, np.pi / 2, 0, "szyz")
+    _trans_x[:3, 3] = np.array([axis_len / 2, 0.0, 0.0])
+    _trans_y = np.eye(4)
+    _trans_y[:3, :3] = euler2mat(0, np.pi / 2, 0, "szxz")
+    _trans_y[:3, 3] = np.array([0.0, axis_len / 2, 0.0])
+    _trans_z = np.eye(4)
+    _trans_z[:3, 3] = np.array([0.0, 0.0, axis_len / 2])
+
+    for _trans, rgb in zip((_trans_x, _trans_y, _trans_z), np.eye(3)):
+        m = trimesh.creation.cylinder(axis_len / ratio, axis_len, transform=_trans, sections=sections)
+        m.visual.vertex_colors = np.ones(m.vertices.shape) * rgb[None]
+        scene.add(pyrender.Mesh.from_trimesh(m, poses=poses))
+
+    return scene
+
+
+def frustum_lines(K, width, height, scale=0.02):
+    """
+    Line segments of a camera frustum in the camera frame
 
+    Input:
+        K -- camera intrinsics calibration matrix
+        width, height -- image size
+        scale -- depth of the frustum base
+    Output:
+        lines -- 16 x 3 array, pairs of end points of the 8 segments
+    """
+    corners = np.array([[0, 0, 1], [width, 0, 1], [width, height, 1], [0, height, 1]], dtype=float)
+    corners = scale * (np.linalg.inv(K) @ corners.T).T
+    apex = np.zeros(3)
+    lines = []
+    for i in range(4):
+        lines += [apex, corners[i], corners[i], corners[(i + 1) % 4]]
+    return np.array(lines, dtype=np.float32)
+
+
+def add_frustums(scene, DATA, scale=0.02, color=(1.0, 1.0, 0.0)):
+    """
+    Add the frustum of every view in DATA, as one mesh with one instanced line primitive per
+    group of views sharing the same K and image size
+    """
+    groups = {}
     for data in DATA:
-        scene = add_coordinate(scene, data["R"].T, -(data["R"].T @ data["T"][:, None])[:, 0])
+        height, width = data["rgb"].shape[:2]
+        key = (data["K"].tobytes(), height, width)
+        groups.setdefault(key, []).append(data)
+
+    primitives = []
+    for views in groups.values():
+        height, width = views[0]["rgb"].shape[:2]
+        lines = frustum_lines(views[0]["K"], width, height, scale)
+        primitives.append(
+            pyrender.Primitive(
+                positions=lines,
+                color_0=np.tile(np.array([*color, 1.0], dtype=np.float32), (lines.shape[0], 1)),
+                mode=pyrender.constants.GLTF.LINES,
+                poses=camera_to_world_poses(views),
+            )
+        )
+    scene.add(pyrender.Mesh(primitives=primitives))
+    return scene
+
+
+def voxel_downsample(pcl, color, voxel_size):
+    """
+    Average the points and colors falling in the same voxel
+
+    Input:
+        pcl -- N x 3 array of points
+        color -- N x 3 array of colors
+        voxel_size -- edge length of the voxels, clamped so that each axis has at most 2**20 voxels
+    Output:
+        pcl, color -- M x 3 arrays, one point per occupied voxel
+    """
+    assert voxel_size > 0, "voxel_size must be positive"
+    if pcl.shape[0] <= 1:
+        return pcl, color
+    bbox_min = pcl.min(axis=0)
+    extent = (pcl.max(axis=0) - bbox_min).max()
+    if extent == 0:
+        return pcl[:1], color[:1]
+    # the flat voxel index of a 2**20 grid per axis fits in int64
+    voxel_size = max(voxel_size, extent / 2**20)
+
+    keys = np.floor((pcl - bbox_min) / voxel_size).astype(np.int64)
+    flat = np.ravel_multi_index(keys.T, keys.max(axis=0) + 1)
+    _, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+
+    def _mean(values):
+        return np.stack(
+            [np.bincount(inverse, weights=values[:, c]) for c in range(values.shape[1])], axis=1
+        ) / counts[:, None]
+
+    return _mean(pcl), _mean(color).astype(color.dtype)
+
+
+def build_lod(pcl, color, voxel_size, max_points):
+    """
+    Level-of-detail hierarchy of a point cloud
+
+    Level 0 is the full cloud, level i voxel-downsamples level i-1 with voxel_size * 2**(i-1).
+    Levels are added until one has at most max_points points.
+    Output:
+        lod -- list of (pcl, color), from the finest to the coarsest level
+    """
+    assert voxel_size > 0, "voxel_size must be positive, the levels double it"
+    assert max_points >= 1, "the coarsest level has at least one point"
+    lod = [(pcl, color)]
+    while lod[-1][0].shape[0] > max_points:
+        lod.append(voxel_downsample(*lod[-1], voxel_size * 2 ** (len(lod) - 1)))
+    return lod
+
+
+def select_lod(lod, max_points):
+    """The finest level with at most max_points points, the coarsest level with a warning if none fits"""
+    for pcl, color in lod:
+        if pcl.shape[0] <= max_points:
+            return pcl, color
+    warnings.warn(f"no LOD level fits {max_points} points, using {lod[-1][0].shape[0]} points")
+    return lod[-1]
+
+
+def look_at(eye, target, up=(0.0, 1.0, 0.0)):
+    """4 x 4 camera to world pose of a pyrender camera (looking along -z) at eye facing target"""
+    eye, target, up = np.asarray(eye, float), np.asarray(target, float), np.asarray(up, float)
+    z = eye - target
+    z /= np.linalg.norm(z) + EPS
+    if abs(z @ up) > 1.0 - 1e-6:
+        up = np.array([1.0, 0.0, 0.0])
+    x = np.cross(up, z)
+    x /= np.linalg.norm(x) + EPS
+    pose = np.eye(4)
+    pose[:3, :3] = np.stack([x, np.cross(z, x), z], axis=1)
+    pose[:3, 3] = eye
+    return pose
+
+
+def render_reconstruction(
+    path,
+    pcl,
+    color,
+    DATA=None,
+    max_points=500000,
+    voxel_size=None,
+    camera_pose=None,
+    size=(640, 480),
+    point_size=2.0,
+):
+    """
+    Render a point cloud, and optionally the camera frustums, offscreen to a PNG
+
+    Only the finest level of the LOD hierarchy with at most max_points points is uploaded to GL,
+    so multi-million point clouds render on headless nodes without a display. pyrender picks its
+    GL platform when it is first imported, so headless jobs must set PYOPENGL_PLATFORM=osmesa
+    (or egl) in the environment before importing any module of this repo.
+
+    Input:
+        path -- output png path
+        pcl -- N x 3 array of world points
+        color -- N x 3 array of uint8 colors
+        DATA -- optional list of views, draws their frustums
+        max_points -- point budget of the rendered level
+        voxel_size -- finest voxel size of the LOD hierarchy, by default 1/1000 of the bbox diagonal,
+            doubled at every coarser level until one fits max_points
+        camera_pose -- 4 x 4 camera to world pose, by default looks at the bbox center along -z
+        size -- (width, height) of the image
+        point_size -- rendered point size in pixels
+    Output:
+        image -- height x width x 3 uint8 rendered image
+    """
+    bbox_min, bbox_max = pcl.min(axis=0), pcl.max(axis=0)
+    # a single point or identical points still get a non-degenerate voxel size and camera distance
+    diag = max(np.linalg.norm(bbox_max - bbox_min), EPS)
+    center = (bbox_min + bbox_max) / 2
+    if voxel_size is None:
+        voxel_size = diag / 1000.0
+    assert voxel_size > 0, "voxel_size must be positive"
+    if camera_pose is None:
+        camera_pose = look_at(center + np.array([0.0, 0.0, 1.5 * diag]), center)
+
+    pcl_lod, color_lod = select_lod(build_lod(pcl, color, voxel_size, max_points), max_points)
+
+    scene = pyrender.Scene(bg_color=[0.0, 0.0, 0.0, 1.0], ambient_light=[1.0, 1.0, 1.0])
+    scene.add(pyrender.Mesh.from_points(pcl_lod, colors=color_lod / 255.0))
+    if DATA is not None:
+        scene = add_frustums(scene, DATA, scale=diag / 10)
+    scene.add(pyrender.PerspectiveCamera(yfov=np.pi / 4, aspectRatio=size[0] / size[1]), pose=camera_pose)
+
+    try:
+        renderer = pyrender.OffscreenRenderer(size[0], size[1], point_size=point_size)
+    except Exception as e:
+        raise RuntimeError(
+            "Cannot create an offscreen GL context, on headless nodes set PYOPENGL_PLATFORM=osmesa "
+            "or egl before pyrender is first imported"
+        ) from e
+    try:
+        image, _ = renderer.render(scene)
+    finally:
+        renderer.delete()
+    imageio.imwrite(path, image)
+    return image
+
+
+def viz_camera_poses(DATA):
+    scene = pyrender.Scene()
+    scene = add_coordinates(scene, camera_to_world_poses(DATA))
     pyrender.Viewer(scene, use_raymond_lighting=True)
     return